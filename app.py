@@ -1,11 +1,58 @@
 import streamlit as st
 import cv2
 import numpy as np
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import io
-from PIL import Image
+import json
+import os
+import sys
+import tempfile
+import threading
 import time
-import base64
+
+# Um único frame por vez não amortiza o fork/join do pool interno do
+# OpenCV, que ainda disputa núcleos com o event loop do Streamlit/Tornado:
+# o caminho single-thread tem o menor tempo de parede aqui
+cv2.setNumThreads(1)
+cv2.setUseOptimized(True)
+
+
+# Backends que fazem sentido tentar na plataforma atual; os demais só
+# gastariam aberturas bloqueantes fadadas a falhar
+if sys.platform == 'linux':
+    PROBE_BACKENDS = [cv2.CAP_V4L2, cv2.CAP_ANY]
+elif sys.platform == 'win32':
+    PROBE_BACKENDS = [cv2.CAP_DSHOW, cv2.CAP_MSMF]
+else:
+    PROBE_BACKENDS = [cv2.CAP_AVFOUNDATION, cv2.CAP_ANY]
+
+
+def existing_video_devices(indices):
+    """Filtra índices para os quais existe um nó /dev/videoN (Linux)."""
+    if sys.platform != 'linux':
+        return list(indices)
+    return [i for i in indices if os.path.exists(f"/dev/video{i}")]
+
+
+# Arquivo com a última combinação (índice, backend) que abriu com sucesso;
+# evita refazer a sondagem toda vez que o app sobe com o mesmo tricoscópio
+LAST_CAMERA_FILE = ".last_camera.json"
+
+# Largura máxima do preview: acima disso o frame é reduzido antes do envio
+# ao navegador; a captura continua usando a resolução completa. A coluna de
+# preview nunca exibe mais largo que isso, então resolução extra seria
+# descartada pelo navegador de qualquer forma
+PREVIEW_MAX_WIDTH = 640
+
+# Resoluções oferecidas na barra lateral (constantes após o startup)
+RESOLUTIONS = {
+    "640x480 (VGA)": (640, 480),
+    "1280x720 (HD)": (1280, 720),
+    "1920x1080 (Full HD)": (1920, 1080),
+    "2592x1944 (5MP)": (2592, 1944)
+}
+
 
 class SafeCamera:
     def __init__(self):
@@ -18,6 +65,11 @@ class SafeCamera:
             (2592, 1944)   # 5MP
         ]
         self.current_resolution_index = 0
+        self._grab_thread = None
+        self._running = threading.Event()
+        self._cap_lock = threading.Lock()
+        self._buf = None
+        self.grab_error = False
 
     def initialize(self, index):
         try:
@@ -26,15 +78,18 @@ class SafeCamera:
             
             st.info(f"Tentando inicializar dispositivo com índice {index}")
             
-            # Lista de tentativas de inicialização
-            attempts = [
-                (index, cv2.CAP_ANY),
-                (index, cv2.CAP_V4L2),
-                (index, cv2.CAP_V4L),
-                (-1, cv2.CAP_ANY),
-                (-1, cv2.CAP_V4L2),
-                (-1, cv2.CAP_V4L)
-            ]
+            # Lista de tentativas restrita aos dispositivos que existem e aos
+            # backends da plataforma, com auto-detecção como último recurso
+            candidates = existing_video_devices([index] if index >= 0 else range(4))
+            attempts = [(idx, backend) for idx in candidates
+                        for backend in PROBE_BACKENDS]
+            attempts.extend((-1, backend) for backend in PROBE_BACKENDS)
+
+            # A combinação que funcionou na última execução vai na frente,
+            # mas nunca por cima de um índice escolhido explicitamente
+            last = self._load_last_camera()
+            if last is not None and (index == -1 or last[0] == index):
+                attempts.insert(0, last)
             
             for idx, backend in attempts:
                 try:
@@ -47,11 +102,22 @@ class SafeCamera:
                         if ret:
                             st.success(f"Câmera inicializada com índice {idx} e backend {backend}")
                             
-                            # Configurações básicas
+                            # MJPG corta ~10x a banda USB versus o YUYV padrão
+                            # e decodifica via libjpeg-turbo; drivers que não
+                            # suportam simplesmente ignoram o pedido
+                            try:
+                                self.cap.set(cv2.CAP_PROP_FOURCC,
+                                             cv2.VideoWriter_fourcc(*'MJPG'))
+                            except Exception:
+                                pass
+
+                            # Configurações básicas: buffer mínimo; o FPS fica
+                            # no nativo do dispositivo, o ritmo vem do V4L2
                             self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-                            self.cap.set(cv2.CAP_PROP_FPS, 15)
-                            
+
                             self.initialized = True
+                            self._save_last_camera(idx, backend)
+                            self._start_grab_thread()
                             return True
                         else:
                             self.cap.release()
@@ -67,34 +133,117 @@ class SafeCamera:
             self.release()
             return False
 
+    @staticmethod
+    def _load_last_camera():
+        """Recupera a combinação (índice, backend) da última abertura bem-sucedida."""
+        try:
+            with open(LAST_CAMERA_FILE) as f:
+                data = json.load(f)
+            return int(data["index"]), int(data["backend"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _save_last_camera(index, backend):
+        try:
+            with open(LAST_CAMERA_FILE, "w") as f:
+                json.dump({"index": index, "backend": backend}, f)
+        except OSError:
+            pass
+
+    def _start_grab_thread(self):
+        """Inicia a thread produtora que drena o buffer do driver continuamente."""
+        self.grab_error = False
+        # Evento novo a cada start: uma thread antiga cujo join expirou fica
+        # presa ao evento dela e nunca é ressuscitada por um start posterior
+        self._running = threading.Event()
+        self._running.set()
+        self._grab_thread = threading.Thread(
+            target=self._grab_loop, args=(self._running,), daemon=True)
+        self._grab_thread.start()
+
+    def _stop_grab_thread(self):
+        self._running.clear()
+        if self._grab_thread is not None:
+            self._grab_thread.join(timeout=1.0)
+            self._grab_thread = None
+
+    def _grab_loop(self, running):
+        # Apenas grab(), sem decodificar: mantém sempre o frame mais recente
+        # disponível e impede o acúmulo de latência no buffer do driver.
+        # Falhas transitórias (ex.: renegociação de formato) são toleradas;
+        # só desiste depois de uma sequência longa de erros consecutivos
+        failures = 0
+        while running.is_set():
+            try:
+                # Lock compartilhado com read(): grab() e retrieve() não podem
+                # tocar o mesmo VideoCapture ao mesmo tempo
+                with self._cap_lock:
+                    grabbed = self.cap is not None and self.cap.grab()
+                if grabbed:
+                    failures = 0
+                    continue
+            except Exception:
+                pass
+            failures += 1
+            if failures >= 30:
+                self.grab_error = True
+                break
+            time.sleep(0.05)
+
     def set_resolution(self, width, height):
         if not self.initialized:
             return None, None
             
+        # Para a thread produtora antes de mexer no formato: o cap.set
+        # renegocia streamoff/streamon no driver e o VideoCapture não é
+        # thread-safe frente a um grab() concorrente
+        self._stop_grab_thread()
         try:
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-            
+
             actual_width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
             actual_height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-            
+
+            # Força a realocação do buffer de frame no próximo read()
+            self._buf = None
+
             return actual_width, actual_height
-            
+
         except Exception as e:
             st.error(f"Erro ao definir resolução: {str(e)}")
             return None, None
+        finally:
+            self._start_grab_thread()
+
+    def _frame_buffer(self):
+        """Buffer reutilizado pelo retrieve(); realocado só quando a resolução muda."""
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if self._buf is None or self._buf.shape[:2] != (height, width):
+            self._buf = np.empty((height, width, 3), dtype=np.uint8)
+        return self._buf
 
     def read(self):
         if not self.initialized or self.cap is None:
             return False, None
+        if self.grab_error:
+            st.error("A câmera parou de fornecer frames")
+            return False, None
         try:
-            return self.cap.read()
+            # Decodifica o último frame capturado pela thread produtora,
+            # escrevendo no buffer pré-alocado em vez de alocar a cada frame;
+            # o lock impede o retrieve() de correr contra o grab() da produtora
+            with self._cap_lock:
+                return self.cap.retrieve(self._frame_buffer())
         except Exception as e:
             st.error(f"Erro na leitura da câmera: {str(e)}")
             return False, None
 
     def release(self):
         try:
+            self._stop_grab_thread()
             if self.cap is not None:
                 self.cap.release()
             self.cap = None
@@ -102,37 +251,99 @@ class SafeCamera:
         except Exception as e:
             st.error(f"Erro ao liberar câmera: {str(e)}")
 
-def detect_cameras():
-    """Detecta câmeras disponíveis no sistema."""
-    available_cameras = []
-    
-    # Adiciona opção de auto-detecção
-    available_cameras.append((-1, "Auto Detect Camera"))
-    
-    # Testa diferentes combinações de índices e backends
-    for i in range(4):
-        for backend in [cv2.CAP_ANY, cv2.CAP_V4L2, cv2.CAP_V4L]:
+def _probe_camera(index):
+    """Retorna (índice, nome) do primeiro backend que entrega um frame, ou None."""
+    for backend in PROBE_BACKENDS:
+        try:
+            cap = cv2.VideoCapture(index, backend)
             try:
-                cap = cv2.VideoCapture(i, backend)
                 if cap.isOpened():
                     ret, frame = cap.read()
                     if ret:
-                        name = f"Camera {i} (Backend {backend})"
-                        available_cameras.append((i, name))
+                        return (index, f"Camera {index} (Backend {backend})")
+            finally:
                 cap.release()
-            except Exception:
-                continue
-    
+        except Exception:
+            continue
+    return None
+
+
+@st.cache_resource(ttl=3600)
+def detect_cameras():
+    """Detecta câmeras disponíveis no sistema (resultado compartilhado entre sessões)."""
+    available_cameras = []
+
+    # Adiciona opção de auto-detecção
+    available_cameras.append((-1, "Auto Detect Camera"))
+
+    # Sonda apenas índices com nó de dispositivo presente — abrir um
+    # /dev/videoN inexistente ainda dispara ioctls V4L2 que podem travar
+    # por 100+ ms. Em paralelo: cada abertura é I/O de kernel, então o
+    # tempo total vira o da sondagem mais lenta
+    candidates = existing_video_devices(range(4)) or [0]
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        for result in executor.map(_probe_camera, candidates):
+            if result is not None:
+                available_cameras.append(result)
+
     return available_cameras
 
-def get_image_download_link(img, filename, text):
-    """Gera um link para download da imagem."""
-    buffered = io.BytesIO()
-    img_pil = Image.fromarray(img)
-    img_pil.save(buffered, format="JPEG", quality=100)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    href = f'<a href="data:image/jpeg;base64,{img_str}" download="{filename}">{text}</a>'
-    return href
+def encode_jpeg(img_bgr):
+    """Codifica a imagem BGR como JPEG e retorna os bytes."""
+    ok, buf = cv2.imencode(
+        ".jpg",
+        img_bgr,
+        [cv2.IMWRITE_JPEG_QUALITY, 92,
+         cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+         cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+    )
+    if not ok:
+        raise ValueError("Falha ao codificar a imagem como JPEG")
+    return buf.tobytes()
+
+
+# Capturas gravadas em disco durante a sessão, removidas na saída do processo
+_capture_files = []
+
+
+def save_capture(jpg_bytes):
+    """Grava a captura JPEG em um arquivo temporário e devolve o caminho."""
+    tf = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+    with tf:
+        tf.write(jpg_bytes)
+    _capture_files.append(tf.name)
+    return tf.name
+
+
+@atexit.register
+def _cleanup_captures():
+    for path in _capture_files:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+@st.fragment(run_every=0.033)
+def render_preview():
+    """Renderiza o frame mais recente da câmera sem bloquear o restante da página."""
+    if not st.session_state.get('camera_active'):
+        return
+    try:
+        ret, frame = st.session_state.camera.read()
+        if ret:
+            if frame.shape[1] > PREVIEW_MAX_WIDTH:
+                height = int(PREVIEW_MAX_WIDTH * frame.shape[0] / frame.shape[1])
+                frame = cv2.resize(frame, (PREVIEW_MAX_WIDTH, height),
+                                   interpolation=cv2.INTER_AREA)
+            # JPEG via libjpeg-turbo é bem mais barato que o PNG que o
+            # st.image geraria a partir do ndarray; bytes vão direto ao navegador
+            ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+            if ok:
+                st.image(buf.tobytes(), use_column_width=True)
+    except Exception as e:
+        st.error(f"Erro na transmissão: {str(e)}")
+        st.session_state.camera_active = False
+        st.session_state.camera.release()
 
 def main():
     st.set_page_config(page_title="Tricoscópio Digital", layout="wide")
@@ -151,36 +362,38 @@ def main():
         st.session_state.camera = SafeCamera()
         st.session_state.camera_active = False
         st.session_state.available_cameras = detect_cameras()
-        st.session_state.last_capture = None
+        # Mapa nome→índice construído uma vez por detecção, não por rerun
+        st.session_state.camera_options = {
+            name: idx for idx, name in st.session_state.available_cameras
+        }
+        st.session_state.last_capture_path = None
     
     with st.sidebar:
         st.header("Controles")
 
         # Seleção de dispositivo
-        available_cameras = st.session_state.available_cameras
-        camera_names = [name for _, name in available_cameras]
-        
+        camera_options = st.session_state.camera_options
+
         selected_camera_name = st.selectbox(
             "Selecione o dispositivo",
-            camera_names,
+            list(camera_options),
             index=0
         )
-        
-        selected_camera_index = next(
-            (idx for idx, name in available_cameras if name == selected_camera_name),
-            -1
-        )
+
+        selected_camera_index = camera_options.get(selected_camera_name, -1)
+
+        if st.button("🔄 Redetectar câmeras"):
+            detect_cameras.clear()
+            st.session_state.available_cameras = detect_cameras()
+            st.session_state.camera_options = {
+                name: idx for idx, name in st.session_state.available_cameras
+            }
+            st.rerun()
 
         # Seleção de resolução
-        resolutions = {
-            "640x480 (VGA)": (640, 480),
-            "1280x720 (HD)": (1280, 720),
-            "1920x1080 (Full HD)": (1920, 1080),
-            "2592x1944 (5MP)": (2592, 1944)
-        }
         selected_resolution = st.selectbox(
             "Selecione a resolução",
-            list(resolutions.keys())
+            list(RESOLUTIONS.keys())
         )
         
         # Botões de controle
@@ -188,7 +401,7 @@ def main():
             if st.button("Iniciar Câmera"):
                 with st.spinner('Inicializando câmera...'):
                     if st.session_state.camera.initialize(selected_camera_index):
-                        width, height = resolutions[selected_resolution]
+                        width, height = RESOLUTIONS[selected_resolution]
                         st.session_state.camera.set_resolution(width, height)
                         st.session_state.camera_active = True
                     else:
@@ -202,8 +415,9 @@ def main():
             if st.button("Capturar Imagem"):
                 ret, frame = st.session_state.camera.read()
                 if ret:
-                    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    st.session_state.last_capture = frame_rgb
+                    # Codifica (BGR direto) e persiste em disco uma única vez;
+                    # a sessão guarda apenas o caminho, não o ndarray de 15 MB
+                    st.session_state.last_capture_path = save_capture(encode_jpeg(frame))
                     st.success("Imagem capturada!")
                 else:
                     st.error("Erro ao capturar imagem")
@@ -213,40 +427,33 @@ def main():
     
     with col1:
         st.header("Visualização em Tempo Real")
-        video_placeholder = st.empty()
-        
+
         if st.session_state.camera_active:
-            try:
-                while st.session_state.camera_active:
-                    ret, frame = st.session_state.camera.read()
-                    if ret:
-                        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        video_placeholder.image(frame_rgb, channels="RGB", use_column_width=True)
-                    time.sleep(0.033)
-            except Exception as e:
-                st.error(f"Erro na transmissão: {str(e)}")
-                st.session_state.camera_active = False
-                st.session_state.camera.release()
+            render_preview()
     
     with col2:
         st.header("Última Captura")
-        if st.session_state.last_capture is not None:
-            st.image(st.session_state.last_capture, caption="Imagem Capturada", use_column_width=True)
-            
+        if st.session_state.last_capture_path is not None:
+            st.image(st.session_state.last_capture_path, caption="Imagem Capturada",
+                     use_column_width=True)
+
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"tricoscopia_{timestamp}.jpg"
-            
-            st.markdown(
-                get_image_download_link(
-                    st.session_state.last_capture,
-                    filename,
-                    "📥 Clique aqui para baixar a imagem"
-                ),
-                unsafe_allow_html=True
-            )
-            
+
+            with open(st.session_state.last_capture_path, "rb") as f:
+                st.download_button(
+                    "📥 Baixar imagem",
+                    data=f.read(),
+                    file_name=filename,
+                    mime="image/jpeg"
+                )
+
             if st.button("Limpar última captura"):
-                st.session_state.last_capture = None
+                try:
+                    os.unlink(st.session_state.last_capture_path)
+                except OSError:
+                    pass
+                st.session_state.last_capture_path = None
                 st.rerun()
 
 if __name__ == "__main__":